@@ -10,7 +10,11 @@ import numpy as np
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import time 
+import threading
+import tempfile
+from collections import deque
 from flask import send_file
+from flask import Response, stream_with_context
 
 app = Flask(__name__)
 CORS(app)
@@ -22,8 +26,8 @@ plate_model = rf.workspace().project("license-plate-recognition-rxg4e").version(
 parking_model = rf.workspace().project("deteksiparkirkosong").version(6).model  # Parking detection model
 
 # ─── Initialize DB ─────────────────────────
-def init_db():
-    conn = sqlite3.connect("plates.db")
+def init_db(db_path="plates.db"):
+    conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
 
     cursor.execute(''' 
@@ -60,8 +64,47 @@ def init_db():
 
 init_db()
 
+# ─── Event Stream State ────────────────────
+# Entry/exit events are replayed from entry_exit_log (its row id is the SSE
+# event id, so clients can resume). Spot assignments and occupancy deltas are
+# not persisted, so they are kept in a short in-memory buffer instead.
+event_condition = threading.Condition()
+event_seq = 0
+live_events = deque(maxlen=200)
+evicted_seq = 0
+last_free_spot_count = None
+subscriber_count = 0
+sampler_thread = None
+EVENT_KEEPALIVE_SECONDS = 15
+OCCUPANCY_SAMPLE_SECONDS = 30
+
+def notify_subscribers():
+    """Wake up stream subscribers after new rows were written to entry_exit_log"""
+    global event_seq
+    with event_condition:
+        event_seq += 1
+        event_condition.notify_all()
+
+def publish_event(event_type, payload):
+    """Push a non-persisted event (spot assignment, occupancy change) to subscribers"""
+    global event_seq, evicted_seq
+    with event_condition:
+        event_seq += 1
+        if len(live_events) == live_events.maxlen:
+            # Subscribers that haven't seen this event yet must resync from a snapshot
+            evicted_seq = live_events[0][0]
+        live_events.append((event_seq, event_type, payload))
+        event_condition.notify_all()
+
 
 # - Preprocess
+def crop_plate(frame, pred):
+    """Crop a plate model prediction (center x/y, width, height) out of the frame"""
+    x, y, w, h = pred["x"], pred["y"], pred["width"], pred["height"]
+    x1, y1 = int(x - w / 2), int(y - h / 2)
+    x2, y2 = int(x + w / 2), int(y + h / 2)
+    return frame[y1:y2, x1:x2]
+
 def resize_plate(plate_img, target_width=300):
     """Resize plate image while maintaining aspect ratio"""
     h, w = plate_img.shape[:2]
@@ -272,6 +315,9 @@ def assign_parking_spot(plate_text, frame, free_spots):
     
     conn.commit()
     conn.close()
+
+    if assigned_spot:
+        publish_event("spot_assigned", {"spot_id": assigned_spot['id'], "plate": plate_text})
     
     return assigned_spot  # Return the assigned spot
 
@@ -298,11 +344,7 @@ def upload():
     
     
     for pred in predictions.get("predictions", []):
-        x, y, w, h = pred["x"], pred["y"], pred["width"], pred["height"]
-        x1, y1 = int(x - w / 2), int(y - h / 2)
-        x2, y2 = int(x + w / 2), int(y + h / 2)
-
-        plate_img = frame[y1:y2, x1:x2]
+        plate_img = crop_plate(frame, pred)
         if plate_img.size == 0:
             continue
 
@@ -340,6 +382,8 @@ def upload():
                 notifications.append({"plate": text, "status": "exit"})
                 
                 # Free up the parking spot when car exits
+                cursor.execute("SELECT spot_id FROM parking_spots WHERE assigned_plate = ?", (text,))
+                released_spots = [row[0] for row in cursor.fetchall()]
                 cursor.execute("DELETE FROM parking_spots WHERE assigned_plate = ?", (text,))
             else:
                 # ENTRY
@@ -352,12 +396,17 @@ def upload():
                     (text, now, "entry", original_b64)
                 )
                 notifications.append({"plate": text, "status": "entry"})
+                released_spots = []
 
                 # Allocate parking if there are free spots
                 
             conn.commit()
             conn.close()
 
+            notify_subscribers()
+            for spot_id in released_spots:
+                publish_event("spot_released", {"spot_id": spot_id, "plate": text})
+
             plates.append({
                 "text": text,
                 "image": original_b64
@@ -378,49 +427,78 @@ def upload():
 # ─── Get Free Parking Spots ────────────────────
 video_path = "parking_1920_1080.mp4"
 cap = None
+# cv2.VideoCapture isn't thread-safe; /parking-status, /assign-parking and the
+# /events occupancy sampler all share it
+video_lock = threading.Lock()
 
-# Modify this function in your Flask app
-def get_free_parking_spots():
-    """
-    Capture current video frame and detect free parking spots using Roboflow model.
-    Returns a list of free parking spot dictionaries.
-    """
-    # Make sure the video is opened correctly
+def read_video_frame():
+    """Read the next frame of the parking video, rewinding at the end. Caller must hold video_lock."""
     global cap
     if cap is None or not cap.isOpened():
         cap = cv2.VideoCapture(video_path)
-    
+
     ret, frame = cap.read()
     if not ret:
         # Reset the video if we reached the end
         cap = cv2.VideoCapture(video_path)
         ret, frame = cap.read()
-        if not ret:
-            print("❌ Could not read frame from video.")
-            return []
+    return frame if ret else None
+
+def parse_free_spots(predictions):
+    """Convert parking model predictions into free parking spot dictionaries"""
+    free_spots = []
+    for i, pred in enumerate(predictions):
+        if pred["class"] == "free":
+            spot = {
+                "id": i + 1,  # Add a unique ID if not present
+                "x": int(pred["x"] - pred["width"] / 2),
+                "y": int(pred["y"] - pred["height"] / 2),
+                "width": int(pred["width"]),
+                "height": int(pred["height"]),
+                "confidence": pred["confidence"],
+                "status": "free"
+            }
+            free_spots.append(spot)
+    return free_spots
 
-    screenshot_path = "temp_frame.jpg"
-    cv2.imwrite(screenshot_path, frame)
+# Modify this function in your Flask app
+def get_free_parking_spots():
+    """
+    Capture current video frame and detect free parking spots using Roboflow model.
+    Returns a list of free parking spot dictionaries.
+    """
+    global last_free_spot_count
+    # A unique file per call so concurrent callers never delete each other's frame
+    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmp:
+        screenshot_path = tmp.name
 
     try:
-        result = parking_model.predict(screenshot_path).json()
+        with video_lock:
+            frame = read_video_frame()
+            if frame is None:
+                print("❌ Could not read frame from video.")
+                return []
+
+            cv2.imwrite(screenshot_path, frame)
+            result = parking_model.predict(screenshot_path).json()
         predictions = result.get("predictions", [])
 
-        free_spots = []
-        for i, pred in enumerate(predictions):
-            if pred["class"] == "free":
-                spot = {
-                    "id": i + 1,  # Add a unique ID if not present
-                    "x": int(pred["x"] - pred["width"] / 2),
-                    "y": int(pred["y"] - pred["height"] / 2),
-                    "width": int(pred["width"]),
-                    "height": int(pred["height"]),
-                    "confidence": pred["confidence"],
-                    "status": "free"
-                }
-                free_spots.append(spot)
+        free_spots = parse_free_spots(predictions)
 
         print(f"✅ Detected {len(free_spots)} free spot(s).")
+
+        # Publish occupancy changes so dashboards don't have to poll /parking-status.
+        # The first measurement has nothing to compare against, so its delta is None.
+        with event_condition:
+            if len(free_spots) != last_free_spot_count:
+                delta = len(free_spots) - last_free_spot_count if last_free_spot_count is not None else None
+                last_free_spot_count = len(free_spots)
+                publish_event("occupancy", {
+                    "free_spot_count": len(free_spots),
+                    "delta": delta,
+                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                })
+
         return free_spots
 
     except Exception as e:
@@ -453,6 +531,146 @@ def get_history():
     return jsonify({"stored_plates": data})
 
 
+# ─── Entry/Exit Event Stream ───────────────
+def occupancy_sampler():
+    """Single background inference loop shared by all /events subscribers"""
+    global sampler_thread
+    while True:
+        with event_condition:
+            if subscriber_count == 0:
+                sampler_thread = None
+                return
+        get_free_parking_spots()
+        time.sleep(OCCUPANCY_SAMPLE_SECONDS)
+
+def start_occupancy_sampler():
+    """Start the occupancy sampler unless it is already running"""
+    global sampler_thread
+    with event_condition:
+        if sampler_thread is None:
+            sampler_thread = threading.Thread(target=occupancy_sampler, daemon=True)
+            sampler_thread.start()
+
+def parking_snapshot():
+    """Current spot assignments and last known free spot count, without running inference"""
+    conn = sqlite3.connect("plates.db")
+    cursor = conn.cursor()
+    cursor.execute("SELECT spot_id, status, assigned_plate, timestamp FROM parking_spots ORDER BY spot_id")
+    spots = cursor.fetchall()
+    conn.close()
+    with event_condition:
+        free_spot_count = last_free_spot_count
+    return {
+        "parking_spots": [
+            {"spot_id": row[0], "status": row[1], "assigned_plate": row[2], "timestamp": row[3]}
+            for row in spots
+        ],
+        "free_spot_count": free_spot_count,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+def latest_log_id():
+    conn = sqlite3.connect("plates.db")
+    cursor = conn.cursor()
+    cursor.execute("SELECT COALESCE(MAX(id), 0) FROM entry_exit_log")
+    latest = cursor.fetchone()[0]
+    conn.close()
+    return latest
+
+def fetch_log_events(last_id):
+    """Return entry_exit_log rows newer than last_id, oldest first"""
+    conn = sqlite3.connect("plates.db")
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT id, plate_text, timestamp, status FROM entry_exit_log WHERE id > ? ORDER BY id",
+        (last_id,)
+    )
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+def format_sse(event_type, payload, event_id=None):
+    """Serialize a single Server-Sent Events message"""
+    message = ""
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    message += f"event: {event_type}\n"
+    message += f"data: {json.dumps(payload)}\n\n"
+    return message
+
+@app.route("/events", methods=["GET"])
+def events():
+    """
+    Server-Sent Events feed of entries/exits, spot assignments and occupancy changes.
+    Entry/exit events carry their entry_exit_log id, so reconnecting clients
+    (Last-Event-ID header or ?last_event_id=) receive everything they missed;
+    without one, the stream starts at the newest log row.
+    spot_assigned, spot_released and occupancy events have no id and are not
+    resumable. Instead every connection starts with a snapshot event (spot
+    assignments + free spot count), and a new snapshot is sent whenever this
+    subscriber fell too far behind and missed some of them.
+    Occupancy is sampled by one shared background loop while anyone is
+    subscribed, so subscribers never trigger inference themselves.
+    """
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    if last_id is None:
+        last_id = latest_log_id()
+    try:
+        last_id = int(last_id)
+    except ValueError:
+        return jsonify({"error": "Invalid last event id"}), 400
+
+    def stream():
+        global subscriber_count
+        cursor_id = last_id
+        with event_condition:
+            seen_seq = event_seq
+            subscriber_count += 1
+        start_occupancy_sampler()
+
+        try:
+            yield format_sse("snapshot", parking_snapshot())
+            yield from stream_events(cursor_id, seen_seq)
+        finally:
+            with event_condition:
+                subscriber_count -= 1
+
+    def stream_events(cursor_id, seen_seq):
+        while True:
+            with event_condition:
+                current_seq = event_seq
+                missed = evicted_seq > seen_seq
+                pending = [e for e in live_events if seen_seq < e[0] <= current_seq]
+
+            if missed:
+                yield format_sse("snapshot", parking_snapshot())
+
+            for row in fetch_log_events(cursor_id):
+                cursor_id = row[0]
+                yield format_sse(row[3], {
+                    "id": row[0],
+                    "plate": row[1],
+                    "timestamp": row[2],
+                    "status": row[3]
+                }, event_id=row[0])
+
+            for _, event_type, payload in pending:
+                yield format_sse(event_type, payload)
+            seen_seq = current_seq
+
+            with event_condition:
+                # Rows may also be written by other processes, so never wait forever
+                timed_out = event_seq == seen_seq and not event_condition.wait(timeout=EVENT_KEEPALIVE_SECONDS)
+            if timed_out:
+                yield ": keep-alive\n\n"
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.route("/parking-status", methods=["GET"])
 def parking_status():
     conn = sqlite3.connect("plates.db")
@@ -504,16 +722,10 @@ def assign_parking():
             return jsonify({"error": "No available parking spots detected"}), 400
         
         # Take a screenshot of the parking area
-        global cap
-        if cap is None or not cap.isOpened():
-            cap = cv2.VideoCapture(video_path)
-        
-        ret, frame = cap.read()
-        if not ret:
-            cap = cv2.VideoCapture(video_path)
-            ret, frame = cap.read()
-            if not ret:
-                return jsonify({"error": "Could not capture parking area"}), 500
+        with video_lock:
+            frame = read_video_frame()
+        if frame is None:
+            return jsonify({"error": "Could not capture parking area"}), 500
         
         # Create a copy of the frame to draw on
         marked_frame = frame.copy()
@@ -551,6 +763,8 @@ def assign_parking():
                 ''', (spot['id'], 'occupied', plate_text, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
                 conn.commit()
                 conn.close()
+
+                publish_event("spot_assigned", {"spot_id": spot['id'], "plate": plate_text})
                 
                 # Convert marked full image to base64
                 _, img_buffer = cv2.imencode('.jpg', marked_frame)
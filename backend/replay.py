@@ -0,0 +1,501 @@
+"""
+Offline replay of recorded footage into the parking database.
+
+Streams a video file (or a directory of images) through frame sampling,
+plate detection + OCR and free-spot detection using a pool of worker
+processes. Entry/exit events go to the entry_exit_log table of replay.db
+(--db) in one transaction per batch; free spots go to a CSV in the
+free_spots.csv schema (optionally Parquet): `frame` is the sample number
+(0, 1, 2, ... for every n-th source frame) and `spot` numbers the free spots
+of that sample from 1.
+
+Whether a sighting is an entry or an exit is decided from the replay's own
+state, never from detected_plates/parking_spots, and only entry_exit_log is
+written. Pointing --db at the live plates.db therefore never changes current
+occupancy, but the back-dated rows do show up in /history and /events.
+
+Progress (next frame, CSV offset, plate state) is checkpointed in the
+replay_checkpoint table of the same database, in the same transaction as the
+entry/exit rows, so an interrupted run resumes where it stopped without
+logging anything twice. Unreadable frames and local OCR errors are logged and
+skipped; Roboflow errors are retried and stop the run (unless --skip-failed)
+before the checkpoint moves past them. --overwrite removes an earlier run's
+rows and checkpoint and starts over.
+
+Usage:
+    python replay.py parking_1920_1080.mp4 --every 30 --workers 4
+    python replay.py recordings/ --output recordings_free_spots.csv --parquet
+"""
+
+import argparse
+import base64
+import csv
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+
+import cv2
+import numpy as np
+
+from app import (
+    crop_plate,
+    init_db,
+    parking_model,
+    plate_model,
+    parse_free_spots,
+    preprocess_plate,
+    recognize_text,
+)
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+CSV_FIELDS = ["frame", "spot", "x", "y", "width", "height", "confidence"]
+
+# Set in each worker by init_worker
+worker_options = {}
+
+
+# ─── Frame Sampling ────────────────────────
+def list_images(image_dir):
+    return sorted(n for n in os.listdir(image_dir) if n.lower().endswith(IMAGE_EXTENSIONS))
+
+def probe_video(video_path):
+    """Return (fps, frame_count) of a video, or None if it can't be opened"""
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened():
+            return None
+        return cap.get(cv2.CAP_PROP_FPS) or 30, int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        cap.release()
+
+def iter_video_frames(video_path, every, start_frame, start_time):
+    """Yield (frame_index, timestamp, jpeg_bytes) for every n-th frame of a video"""
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30
+    index = 0
+    try:
+        while True:
+            # grab() skips decoding work for frames we don't keep
+            if not cap.grab():
+                break
+            if index >= start_frame and index % every == 0:
+                ret, frame = cap.retrieve()
+                if ret:
+                    timestamp = start_time + timedelta(seconds=index / fps)
+                    _, buffer = cv2.imencode(".jpg", frame)
+                    yield index, timestamp.strftime(TIMESTAMP_FORMAT), buffer.tobytes()
+            index += 1
+    finally:
+        cap.release()
+
+def iter_image_frames(image_dir, every, start_frame):
+    """Yield (frame_index, timestamp, image_path) for every n-th image in a directory"""
+    for index, name in enumerate(list_images(image_dir)):
+        if index >= start_frame and index % every == 0:
+            path = os.path.join(image_dir, name)
+            timestamp = datetime.fromtimestamp(os.path.getmtime(path))
+            yield index, timestamp.strftime(TIMESTAMP_FORMAT), path
+
+
+# ─── Worker ────────────────────────────────
+class TransientError(Exception):
+    """A Roboflow request failed; the same frame may succeed when retried"""
+
+def predict(model, image_path, **kwargs):
+    try:
+        return model.predict(image_path, **kwargs).json()
+    except Exception as e:
+        raise TransientError(str(e)) from e
+
+def init_worker(detect_plates, detect_spots, temp_dir):
+    worker_options.update(detect_plates=detect_plates, detect_spots=detect_spots, temp_dir=temp_dir)
+
+def process_frame(task):
+    """
+    Run plate OCR and free-spot detection on one sampled frame.
+    Returns (frame_index, timestamp, plates, free_spots, error, transient).
+    """
+    index, timestamp, source = task
+    temp_path = None
+    try:
+        if isinstance(source, bytes):
+            # Roboflow models predict from a file path, same as the Flask app
+            temp_path = os.path.join(worker_options["temp_dir"], f"replay_{os.getpid()}.jpg")
+            with open(temp_path, "wb") as f:
+                f.write(source)
+            image_path = temp_path
+            frame = cv2.imdecode(np.frombuffer(source, np.uint8), cv2.IMREAD_COLOR)
+        else:
+            image_path = source
+            frame = cv2.imread(source)
+
+        if frame is None:
+            return index, timestamp, [], [], "could not read frame", False
+
+        plates = []
+        if worker_options["detect_plates"]:
+            predictions = predict(plate_model, image_path, confidence=40)
+            for pred in predictions.get("predictions", []):
+                plate_img = crop_plate(frame, pred)
+                if plate_img.size == 0:
+                    continue
+                processed_images = preprocess_plate(plate_img)
+                if processed_images is None:
+                    continue
+                text = recognize_text(processed_images)
+                if len(text) >= 4:
+                    _, buffer = cv2.imencode('.jpg', plate_img)
+                    plates.append((text, base64.b64encode(buffer).decode('utf-8')))
+
+        free_spots = []
+        if worker_options["detect_spots"]:
+            result = predict(parking_model, image_path)
+            free_spots = parse_free_spots(result.get("predictions", []))
+
+        return index, timestamp, plates, free_spots, None, False
+
+    except TransientError as e:
+        return index, timestamp, [], [], str(e), True
+
+    except Exception as e:
+        # Local decoding/OCR errors fail the same way every time
+        return index, timestamp, [], [], str(e), False
+
+    finally:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+# ─── Checkpoint ────────────────────────────
+def init_checkpoint_table(conn):
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS replay_checkpoint (
+                source TEXT NOT NULL,
+                output TEXT NOT NULL,
+                settings TEXT NOT NULL,
+                next_frame INTEGER NOT NULL,
+                csv_offset INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                completed INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (source, output)
+            )
+        ''')
+        # entry_exit_log rows written by each replay, so --overwrite can remove them
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS replay_log (
+                source TEXT NOT NULL,
+                output TEXT NOT NULL,
+                log_id INTEGER NOT NULL
+            )
+        ''')
+
+def load_checkpoint(conn, source, output):
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT settings, next_frame, csv_offset, state, completed FROM replay_checkpoint "
+        "WHERE source = ? AND output = ?",
+        (source, output)
+    )
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return {
+        "settings": json.loads(row[0]),
+        "next_frame": row[1],
+        "csv_offset": row[2],
+        "state": json.loads(row[3]),
+        "completed": bool(row[4])
+    }
+
+def save_checkpoint(cursor, source, output, checkpoint):
+    # Called inside the batch transaction, so the checkpoint and the log rows commit together
+    cursor.execute(
+        "INSERT OR REPLACE INTO replay_checkpoint "
+        "(source, output, settings, next_frame, csv_offset, state, completed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (source, output, json.dumps(checkpoint["settings"]), checkpoint["next_frame"],
+         checkpoint["csv_offset"], json.dumps(checkpoint["state"]), int(checkpoint["completed"]))
+    )
+
+def delete_replay(conn, source, output):
+    """Remove a previous run's log rows and checkpoint"""
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM entry_exit_log WHERE id IN "
+            "(SELECT log_id FROM replay_log WHERE source = ? AND output = ?)",
+            (source, output)
+        )
+        removed = cursor.rowcount
+        cursor.execute("DELETE FROM replay_log WHERE source = ? AND output = ?", (source, output))
+        cursor.execute("DELETE FROM replay_checkpoint WHERE source = ? AND output = ?", (source, output))
+    return removed
+
+
+# ─── Bulk Writers ──────────────────────────
+def write_plate_batch(cursor, results, state, dedup_seconds, source, output):
+    """
+    Log entries/exits for a batch of frames. The caller owns the transaction.
+    A plate seen again within dedup_seconds of its previous sighting is the
+    same visit and is not logged again; otherwise it alternates entry/exit
+    based on state["inside"]. Returns the number of log rows written.
+    """
+    last_seen = state["last_seen"]
+    inside = set(state["inside"])
+    written = 0
+    for _, timestamp, plates, _, _, _ in results:
+        seen_at = datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+        for text, image_b64 in plates:
+            previous = last_seen.get(text)
+            last_seen[text] = timestamp
+            if previous and (seen_at - datetime.strptime(previous, TIMESTAMP_FORMAT)).total_seconds() <= dedup_seconds:
+                continue
+
+            if text in inside:
+                inside.remove(text)
+                status = "exit"
+            else:
+                inside.add(text)
+                status = "entry"
+            cursor.execute(
+                "INSERT INTO entry_exit_log (plate_text, timestamp, status, image_base64) VALUES (?, ?, ?, ?)",
+                (text, timestamp, status, image_b64)
+            )
+            cursor.execute(
+                "INSERT INTO replay_log (source, output, log_id) VALUES (?, ?, ?)",
+                (source, output, cursor.lastrowid)
+            )
+            written += 1
+
+    state["inside"] = sorted(inside)
+    return written
+
+def write_spot_batch(csv_file, results, every):
+    """Append free spots in the free_spots.csv convention: sample number, spots numbered 1..N"""
+    writer = csv.writer(csv_file)
+    for index, _, _, free_spots, _, _ in results:
+        for spot_number, spot in enumerate(free_spots, start=1):
+            writer.writerow([index // every, spot_number, spot["x"], spot["y"],
+                             spot["width"], spot["height"], spot["confidence"]])
+    csv_file.flush()
+    os.fsync(csv_file.fileno())
+    return csv_file.tell()
+
+def write_parquet(csv_path):
+    try:
+        import pandas as pd
+    except ImportError:
+        print("❌ pandas and pyarrow are required for --parquet, skipping.")
+        return None
+    parquet_path = os.path.splitext(csv_path)[0] + ".parquet"
+    try:
+        pd.read_csv(csv_path).to_parquet(parquet_path, index=False)
+    except ImportError as e:
+        # pandas is installed but no Parquet engine (pyarrow/fastparquet) is
+        print(f"❌ {e}, skipping.")
+        return None
+    return parquet_path
+
+
+# ─── Main ──────────────────────────────────
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay recorded video or images into the parking database.")
+    parser.add_argument("source", help="Video file or directory of images")
+    parser.add_argument("--every", type=int, default=30, help="Process every n-th frame (default: 30)")
+    parser.add_argument("--workers", type=int, default=cpu_count(), help="Number of worker processes")
+    parser.add_argument("--batch-size", type=int, default=64, help="Sampled frames per DB transaction/checkpoint")
+    parser.add_argument("--retries", type=int, default=2, help="Retries for frames with Roboflow errors")
+    parser.add_argument("--skip-failed", action="store_true",
+                        help="Skip frames that still fail after all retries instead of stopping")
+    parser.add_argument("--db", default="replay.db",
+                        help="SQLite database for entry/exit events (default: replay.db, not the live plates.db)")
+    parser.add_argument("--output", help="CSV file for detected free spots (default: <source name>_free_spots.csv)")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Discard an earlier run of this source/output (log rows, checkpoint, CSV) and start over")
+    parser.add_argument("--parquet", action="store_true", help="Also write the free spots as Parquet when done")
+    parser.add_argument("--start-time", help="Wall-clock time of the first video frame, 'YYYY-MM-DD HH:MM:SS' "
+                                             "(default: file modification time minus the video length)")
+    parser.add_argument("--dedup-seconds", type=float, default=60,
+                        help="Sightings of the same plate closer than this count as one visit")
+    parser.add_argument("--no-plates", action="store_true", help="Skip plate detection/OCR")
+    parser.add_argument("--no-spots", action="store_true", help="Skip free spot detection")
+    args = parser.parse_args()
+
+    for name in ("every", "workers", "batch_size"):
+        if getattr(args, name) < 1:
+            parser.error(f"--{name.replace('_', '-')} must be at least 1")
+    if args.retries < 0:
+        parser.error("--retries must not be negative")
+    if args.start_time:
+        try:
+            args.start_time = datetime.strptime(args.start_time, TIMESTAMP_FORMAT)
+        except ValueError:
+            parser.error(f"--start-time must look like {datetime.now().strftime(TIMESTAMP_FORMAT)}")
+    if not args.output:
+        name = os.path.splitext(os.path.basename(os.path.normpath(args.source)))[0]
+        args.output = f"{name}_free_spots.csv"
+    return args
+
+def open_frames(args, start_frame):
+    """Validate the source and return its frame iterator; exits before any output is touched"""
+    if os.path.isdir(args.source):
+        if not list_images(args.source):
+            raise SystemExit(f"❌ No images found in {args.source}")
+        return iter_image_frames(args.source, args.every, start_frame)
+
+    if not os.path.isfile(args.source):
+        raise SystemExit(f"❌ {args.source} does not exist")
+    video = probe_video(args.source)
+    if video is None:
+        raise SystemExit(f"❌ Could not open video {args.source}")
+    fps, frame_count = video
+
+    start_time = args.start_time
+    if start_time is None:
+        # The file is last modified when recording ends, so step back by the video length
+        start_time = datetime.fromtimestamp(os.path.getmtime(args.source)) - timedelta(seconds=frame_count / fps)
+    return iter_video_frames(args.source, args.every, start_frame, start_time)
+
+def run_batch(pool, tasks, retries, skip_failed):
+    """
+    Process a batch of frames, retrying transient failures with backoff.
+    Returns (results, error): results in frame order, including frames that
+    failed for good (they are skipped), cut off before the first frame that
+    still fails transiently unless skip_failed; error describes that frame.
+    """
+    results = {task[0]: None for task in tasks}
+    pending = tasks
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(2 ** attempt)
+        for result in pool.map(process_frame, pending, chunksize=1):
+            results[result[0]] = result
+        pending = [task for task in pending if results[task[0]][5]]
+        if not pending:
+            break
+        print(f"❌ {len(pending)} frame(s) failed (attempt {attempt + 1}/{retries + 1})")
+
+    done = []
+    for task in tasks:
+        result = results[task[0]]
+        if result[5] and not skip_failed:
+            return done, f"frame {result[0]}: {result[4]}"
+        if result[4]:
+            print(f"❌ Skipping frame {result[0]}: {result[4]}")
+        done.append(result)
+    return done, None
+
+def main():
+    args = parse_args()
+    source = os.path.abspath(args.source)
+    output = os.path.abspath(args.output)
+    settings = {"every": args.every, "plates": not args.no_plates, "spots": not args.no_spots}
+
+    init_db(args.db)
+    conn = sqlite3.connect(args.db)
+    init_checkpoint_table(conn)
+    checkpoint = load_checkpoint(conn, source, output)
+    resume = checkpoint is not None and not args.overwrite
+
+    # Validate everything before the output file or the database is changed
+    if resume:
+        if checkpoint["completed"]:
+            raise SystemExit(f"❌ {args.source} was already imported into {args.db}, pass --overwrite to redo it")
+        if checkpoint["settings"] != settings:
+            raise SystemExit(f"❌ Checkpoint was made with {checkpoint['settings']}, not {settings}; "
+                             f"use the same options or pass --overwrite")
+        if not os.path.exists(args.output) or os.path.getsize(args.output) < checkpoint["csv_offset"]:
+            raise SystemExit(f"❌ {args.output} is missing or shorter than the checkpoint, "
+                             f"pass --overwrite to start over")
+    elif os.path.exists(args.output) and not args.overwrite:
+        raise SystemExit(f"❌ {args.output} already exists, pass --overwrite or choose another --output")
+    frames = open_frames(args, checkpoint["next_frame"] if resume else 0)
+
+    if resume:
+        print(f"Resuming {args.source} from frame {checkpoint['next_frame']}")
+        # Drop CSV rows written after the last checkpoint
+        with open(args.output, "r+") as f:
+            f.truncate(checkpoint["csv_offset"])
+    else:
+        if checkpoint:
+            removed = delete_replay(conn, source, output)
+            print(f"Discarded previous run of {args.source} ({removed} entry/exit rows)")
+        checkpoint = {
+            "settings": settings,
+            "next_frame": 0,
+            "csv_offset": 0,
+            "state": {"last_seen": {}, "inside": [], "skipped": []},
+            "completed": False
+        }
+        with open(args.output, "w", newline="") as f:
+            csv.writer(f).writerow(CSV_FIELDS)
+            checkpoint["csv_offset"] = f.tell()
+
+    os.makedirs("temp", exist_ok=True)
+
+    processed = 0
+    events = 0
+    failure = None
+    started = time.time()
+
+    def flush(csv_file, batch):
+        nonlocal events
+        # CSV first: if we die before the commit, resume truncates these rows again
+        checkpoint["csv_offset"] = write_spot_batch(csv_file, batch, args.every)
+        checkpoint["next_frame"] = batch[-1][0] + 1
+        checkpoint["state"]["skipped"] += [result[0] for result in batch if result[4]]
+        with conn:
+            cursor = conn.cursor()
+            events += write_plate_batch(cursor, batch, checkpoint["state"], args.dedup_seconds, source, output)
+            save_checkpoint(cursor, source, output, checkpoint)
+        rate = processed / (time.time() - started)
+        print(f"✅ Frame {checkpoint['next_frame'] - 1}: {processed} frames, {rate:.2f} frames/sec, {events} events")
+
+    pool = Pool(args.workers, initializer=init_worker,
+                initargs=(not args.no_plates, not args.no_spots, "temp"))
+    try:
+        with open(args.output, "a", newline="") as csv_file:
+            while not failure:
+                # Submit one batch at a time so decoded frames never pile up in memory;
+                # results stay in frame order, so the checkpoint always marks a contiguous prefix
+                tasks = list(islice(frames, args.batch_size))
+                if not tasks:
+                    break
+                batch, failure = run_batch(pool, tasks, args.retries, args.skip_failed)
+                processed += len(batch)
+                if batch:
+                    flush(csv_file, batch)
+
+        if not failure:
+            checkpoint["completed"] = True
+            with conn:
+                save_checkpoint(conn.cursor(), source, output, checkpoint)
+    finally:
+        pool.terminate()
+        conn.close()
+
+    elapsed = time.time() - started
+    rate = processed / elapsed if elapsed else 0
+    skipped = checkpoint["state"]["skipped"]
+    print(f"Processed {processed} frames in {elapsed:.1f}s ({rate:.2f} frames/sec), {events} entry/exit events.")
+    if skipped:
+        print(f"❌ Skipped {len(skipped)} frame(s) that could not be processed: {skipped}")
+
+    if failure:
+        raise SystemExit(f"❌ Stopped at {failure}. Run the same command again to resume from this frame, "
+                         f"or add --skip-failed to skip it.")
+
+    if args.parquet:
+        parquet_path = write_parquet(args.output)
+        if parquet_path:
+            print(f"✅ Wrote {parquet_path}")
+
+
+if __name__ == "__main__":
+    main()